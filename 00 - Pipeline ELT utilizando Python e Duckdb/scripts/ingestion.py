@@ -9,8 +9,7 @@ Data: Abril 2025
 """
 
 import os
-from datetime import datetime
-import pandas as pd
+from pathlib import Path
 import duckdb
 import logging
 import time
@@ -24,9 +23,20 @@ logger = logging.getLogger()
 
 # Constantes globais
 LANDING_DIR = '../landing'
+LANDING_PARQUET_DIR = '../landing_parquet'  # Cópia em Parquet dos CSVs da landing
+# Versão do esquema dos Parquet da landing: incrementar ao alterar a conversão
+# (tipos ou colunas), para que cópias antigas não sejam reaproveitadas
+LANDING_PARQUET_VERSION = 'v3'
 DB_FILE = 'dados_duckdb.db'
 EXT = '.csv'
 
+# Configurações de desempenho do DuckDB
+DUCKDB_THREADS = os.cpu_count() or 1
+# Limite de memória opcional (ex.: '8GB'); sem a variável, mantém o padrão do DuckDB (80% da RAM)
+DUCKDB_MEMORY_LIMIT = os.environ.get('DUCKDB_MEMORY_LIMIT')
+# Diretório temporário em disco para spill de consultas que excedem a memória
+DUCKDB_TEMP_DIR = os.environ.get('DUCKDB_TEMP_DIR', '.duckdb_tmp')
+
 # Inicia a medição do tempo
 start_time = time.time()
 logger.info("Iniciando medição do tempo de execução do pipeline")
@@ -38,55 +48,160 @@ logger.info("Iniciando processo ETL - Camada Bronze")
 
 # Inicializa conexão com DuckDB
 con = duckdb.connect(database=DB_FILE, read_only=False)
-logger.info(f"Conexão estabelecida com o banco {DB_FILE}")
+logger.info("Conexão estabelecida com o banco %s", DB_FILE)
+
+# Ajusta paralelismo e memória da conexão
+# - preserve_insertion_order=false permite cargas e consultas paralelas sem ordenação final
+# - valores vindos de variáveis de ambiente têm aspas simples escapadas no literal SQL
+con.execute(f"PRAGMA threads={DUCKDB_THREADS}")
+if DUCKDB_MEMORY_LIMIT:
+    memory_limit_sql = DUCKDB_MEMORY_LIMIT.replace("'", "''")
+    con.execute(f"SET memory_limit = '{memory_limit_sql}'")
+con.execute("PRAGMA preserve_insertion_order=false")
+temp_dir_sql = DUCKDB_TEMP_DIR.replace("'", "''")
+con.execute(f"SET temp_directory = '{temp_dir_sql}'")
 
 # Define nome da tabela para camada bronze
 TABLE_NAME_BRONZE = 'bronze_produtos'
 
-# Remove tabela existente, se houver (idempotência)
-con.execute(f"DROP TABLE IF EXISTS {TABLE_NAME_BRONZE}")
-
-# Cria tabela bronze_produtos com esquema apropriado
-con.execute(f"""
-    CREATE TABLE IF NOT EXISTS {TABLE_NAME_BRONZE} (
-        NATBR VARCHAR,    -- ID do produto
-        MAKTX VARCHAR,    -- Nome do produto
-        WERKS VARCHAR,    -- ID da categoria
-        MAINS VARCHAR,    -- Fornecedor
-        LABST VARCHAR,    -- Preço
-        ingest_time TIMESTAMP,  -- Timestamp de ingestão
-        file_name VARCHAR        -- Arquivo de origem
-    )
-""")
+# Executa toda a carga bronze em uma única transação (um único commit)
+con.execute("BEGIN TRANSACTION")
 
 # Lista arquivos CSV na pasta de landing
 try:
-    csv_files = [f for f in os.listdir(LANDING_DIR) if f.endswith(EXT)]
-    logger.info(f"Encontrados {len(csv_files)} arquivos para processamento")
+    landing_path = Path(LANDING_DIR)
+    if not landing_path.is_dir():
+        raise FileNotFoundError(f"Diretório de landing não encontrado: {LANDING_DIR}")
+    csv_files = list(landing_path.glob(f'*{EXT}'))
+    logger.info("Encontrados %d arquivos para processamento", len(csv_files))
 except Exception as e:
-    logger.error(f"Erro ao listar arquivos CSV: {e}")
+    logger.error("Erro ao listar arquivos CSV: %s", e)
+    con.execute("ROLLBACK")
     raise
 
-# Itera sobre os arquivos CSV e insere os dados na camada bronze
-for file in csv_files:
+# Converte para Parquet (um arquivo por CSV, com o nome do CSV de origem como
+# coluna) apenas os CSVs novos ou alterados desde a última execução, evitando
+# reprocessar texto a cada carga. A identidade do CSV (mtime em ns e tamanho)
+# faz parte do nome do Parquet: qualquer diferença, inclusive um mtime mais
+# antigo (cp -p, rsync -t, extração de tar/zip), gera uma nova conversão.
+# A instrução é definida uma única vez e os valores são passados como parâmetros nomeados
+SQL_CSV_TO_PARQUET = """
+    COPY (
+        SELECT
+            *,
+            $file_name AS file_name,
+            make_timestamp($file_mtime_us) AS file_mtime  -- Data de modificação do CSV
+        FROM read_csv_auto(
+            $csv_path,
+            header=true,
+            columns={
+                'NATBR': 'BIGINT',
+                'MAKTX': 'VARCHAR',
+                'WERKS': 'VARCHAR',
+                'MAINS': 'BIGINT',
+                'LABST': 'REAL'
+            }
+        )
+    ) TO $parquet_path (FORMAT PARQUET)
+"""
+
+# Mantém a ordem das linhas do CSV no Parquet: a posição da linha no arquivo
+# (file_row_number) é usada como critério de desempate na deduplicação da silver
+con.execute("SET preserve_insertion_order = true")
+
+parquet_files = []
+for csv_path in csv_files:
+    file = csv_path.name
+    csv_stat = csv_path.stat()
+    parquet_path = os.path.join(
+        LANDING_PARQUET_DIR,
+        f"{file}.{LANDING_PARQUET_VERSION}.{csv_stat.st_mtime_ns}-{csv_stat.st_size}.parquet"
+    )
+    parquet_files.append(parquet_path)
+
+    if os.path.exists(parquet_path):
+        continue
+
     try:
-        file_path = os.path.join(LANDING_DIR, file)
-        ingest_time = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-        
-        # Lê o CSV e adiciona metadados
-        df = pd.read_csv(file_path)
-        df['ingest_time'] = ingest_time
-        df['file_name'] = file
-        
-        # Insere dados no DuckDB
-        con.execute(f"INSERT INTO {TABLE_NAME_BRONZE} SELECT * FROM df")
-        logger.info(f"Arquivo {file} processado com sucesso: {len(df)} registros")
+        os.makedirs(LANDING_PARQUET_DIR, exist_ok=True)
+        con.execute(SQL_CSV_TO_PARQUET, {
+            'csv_path': str(csv_path),
+            'parquet_path': parquet_path,
+            'file_name': file,
+            'file_mtime_us': csv_stat.st_mtime_ns // 1000
+        })
+        logger.info("Arquivo %s convertido para Parquet", file)
     except Exception as e:
-        logger.error(f"Erro ao processar arquivo {file}: {e}")
+        logger.error("Erro ao converter arquivo %s para Parquet: %s", file, e)
+        con.execute("ROLLBACK")
+        raise
+
+con.execute("SET preserve_insertion_order = false")
+
+# Remove cópias em Parquet que não correspondem mais a nenhum CSV atual
+# (versões antigas da conversão, CSVs alterados ou removidos da landing)
+if os.path.isdir(LANDING_PARQUET_DIR):
+    current_parquet_names = {os.path.basename(path) for path in parquet_files}
+    for stale_name in os.listdir(LANDING_PARQUET_DIR):
+        if stale_name not in current_parquet_names:
+            os.remove(os.path.join(LANDING_PARQUET_DIR, stale_name))
+            logger.info("Cópia em Parquet obsoleta removida: %s", stale_name)
+
+# Recria a tabela bronze lendo todos os Parquet da landing de uma só vez, já nos
+# tipos finais e com os metadados de ingestão calculados no SQL
+# (CTAS: carga em bloco, sem laço em Python e idempotente).
+# A lista de arquivos é passada como parâmetro, sem montar caminhos no texto SQL
+if csv_files:
+    try:
+        con.execute(f"""
+            CREATE OR REPLACE TABLE {TABLE_NAME_BRONZE} AS
+            SELECT
+                NATBR,  -- ID do produto
+                MAKTX,  -- Nome do produto
+                WERKS,  -- ID da categoria
+                MAINS,  -- Fornecedor
+                LABST,  -- Preço
+                CAST(CURRENT_TIMESTAMP AS TIMESTAMP) AS ingest_time,  -- Timestamp de ingestão
+                file_name,  -- Arquivo de origem
+                file_mtime,  -- Data de modificação do arquivo de origem
+                file_row_number  -- Posição da linha no arquivo de origem
+            FROM read_parquet($parquet_files, file_row_number=true)
+        """, {'parquet_files': parquet_files})
+    except Exception as e:
+        logger.error("Erro ao carregar arquivos da landing na camada Bronze: %s", e)
+        con.execute("ROLLBACK")
+        raise
+else:
+    # Sem arquivos na landing: cria a bronze vazia, com o mesmo esquema tipado,
+    # para que as camadas seguintes sejam executadas normalmente
+    logger.warning("Nenhum arquivo encontrado em %s: camada Bronze criada vazia", LANDING_DIR)
+    con.execute(f"""
+        CREATE OR REPLACE TABLE {TABLE_NAME_BRONZE} (
+            NATBR BIGINT,     -- ID do produto
+            MAKTX VARCHAR,    -- Nome do produto
+            WERKS VARCHAR,    -- ID da categoria
+            MAINS BIGINT,     -- Fornecedor
+            LABST REAL,       -- Preço
+            ingest_time TIMESTAMP,  -- Timestamp de ingestão
+            file_name VARCHAR,       -- Arquivo de origem
+            file_mtime TIMESTAMP,    -- Data de modificação do arquivo de origem
+            file_row_number BIGINT   -- Posição da linha no arquivo de origem
+        )
+    """)
+
+con.execute("COMMIT")
+
+# Registra a quantidade de registros carregados por arquivo; o total da
+# camada bronze é a soma dessas contagens (sem nova varredura da tabela)
+bronze_file_counts = con.execute(f"""
+    SELECT file_name, COUNT(*) FROM {TABLE_NAME_BRONZE} GROUP BY file_name ORDER BY file_name
+""").fetchall()
+for file, total in bronze_file_counts:
+    logger.info("Arquivo %s processado com sucesso: %d registros", file, total)
 
 # Exibe resultado para conferência
-bronze_result = con.execute(f"SELECT COUNT(*) as total_records FROM {TABLE_NAME_BRONZE}").fetchone()
-logger.info(f"Total de registros na camada Bronze: {bronze_result[0]}")
+bronze_count = sum(total for _, total in bronze_file_counts)
+logger.info("Total de registros na camada Bronze: %d", bronze_count)
 
 
 # ------------------------------------------------------------
@@ -97,75 +212,44 @@ logger.info("Iniciando processo ETL - Camada Silver")
 # Define nome da tabela para camada silver
 TABLE_NAME_SILVER = 'silver_produtos'
 
-# Obtém os registros mais recentes de cada produto (deduplicação)
-# usando window function para ranquear por timestamp de ingestão
+# Cria a tabela silver inteiramente em SQL (CTAS):
+# - Obtém os registros mais recentes de cada produto (deduplicação)
+#   usando DISTINCT ON para manter o último registro por timestamp de ingestão.
+#   Na mesma carga (mesmo ingest_time) vence o arquivo modificado mais
+#   recentemente (file_mtime) e, dentro dele, a última linha (file_row_number).
+#   O nome do arquivo só desempata arquivos com a mesma data de modificação
+# - Remove colunas de metadados da bronze
+# - Renomeia colunas conforme padrão de negócio (tipos já vêm da bronze)
+# - Adiciona timestamp de processamento
 try:
-    silver_df = con.execute("""
-        WITH ranked AS (
-            SELECT *,
-                ROW_NUMBER() OVER (PARTITION BY NATBR ORDER BY ingest_time DESC) AS rn
-            FROM bronze_produtos
-            WHERE ingest_time >= '2025-01-01 00:00:00'  -- Filtra por data recente
+    con.execute(f"""
+        CREATE OR REPLACE TABLE {TABLE_NAME_SILVER} AS
+        SELECT
+            NATBR AS id,
+            MAKTX AS prod_name,
+            WERKS AS id_category,
+            MAINS AS supplier,
+            LABST AS price,
+            CAST(CURRENT_TIMESTAMP AS TIMESTAMP) AS ingest_time
+        FROM (
+            SELECT DISTINCT ON (NATBR) *
+            FROM {TABLE_NAME_BRONZE}
+            WHERE ingest_time >= TIMESTAMP '2025-01-01 00:00:00'  -- Filtra por data recente
+            ORDER BY
+                NATBR,
+                ingest_time DESC,
+                file_mtime DESC,
+                file_name DESC,
+                file_row_number DESC  -- Mantém apenas o registro mais recente
         )
-        SELECT *
-        FROM ranked
-        WHERE rn = 1  -- Seleciona apenas o registro mais recente
-    """).fetchdf()
-    
-    logger.info(f"Dados extraídos para camada Silver: {len(silver_df)} registros únicos")
-except Exception as e:
-    logger.error(f"Erro ao processar dados para camada Silver: {e}")
-    raise
+    """)
 
-# Limpeza e transformação dos dados
-# - Remove colunas desnecessárias
-# - Renomeia colunas conforme padrão de negócio
-# - Converte tipos de dados
-silver_df.drop(columns=['ingest_time', 'file_name', 'rn'], inplace=True)
-
-# Renomeia colunas para nomes mais significativos
-silver_df.rename(columns={
-    'NATBR': 'id',  
-    'MAKTX': 'prod_name',  
-    'WERKS': 'id_category', 
-    'MAINS': 'supplier',  
-    'LABST': 'price'
-}, inplace=True)
-
-# Converte tipos de dados para os formatos corretos
-try:
-    silver_df = silver_df.astype({
-        'id': 'int64',
-        'prod_name': 'string',
-        'id_category': 'string',
-        'supplier': 'int64',
-        'price': 'float32'
-    })
+    silver_count = con.execute(f"SELECT COUNT(*) FROM {TABLE_NAME_SILVER}").fetchone()[0]
+    logger.info("Dados inseridos na camada Silver com sucesso: %d registros únicos", silver_count)
 except Exception as e:
-    logger.error(f"Erro na conversão de tipos de dados: {e}")
+    logger.error("Erro ao processar dados para camada Silver: %s", e)
     raise
 
-# Adiciona timestamp de processamento
-silver_df['ingest_time'] = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-
-# Cria tabela silver_produtos
-con.execute(f"DROP TABLE IF EXISTS {TABLE_NAME_SILVER}")
-
-con.execute(f"""
-    CREATE TABLE IF NOT EXISTS {TABLE_NAME_SILVER} (
-        id bigint,
-        prod_name string,
-        id_category string,
-        supplier bigint,
-        price float,
-        ingest_time timestamp
-    )
-""")
-
-# Insere dados transformados na tabela silver
-con.execute(f"INSERT INTO {TABLE_NAME_SILVER} SELECT * FROM silver_df")
-logger.info("Dados inseridos na camada Silver com sucesso")
-
 
 # ------------------------------------------------------------
 # Camada Gold - Modelagem dimensional
@@ -176,68 +260,53 @@ logger.info("Iniciando processo ETL - Camada Gold")
 TABLE_NAME_FAT = 'gold_produtos_fat'    # Tabela fato
 TABLE_NAME_DIM = 'gold_produtos_dim'    # Tabela dimensão
 
+# Cria fato e dimensão na mesma transação: a silver é lida com o buffer
+# aquecido pela primeira leitura e a camada gold é publicada de uma só vez.
+# Como a silver já possui um único registro por id (DISTINCT ON), as tabelas
+# gold são apenas projeções, sem necessidade de DISTINCT/GROUP BY, e têm a
+# mesma quantidade de registros da silver (sem nova contagem)
+con.execute("BEGIN TRANSACTION")
+
 # Cria tabela fato com id, nome e preço
 try:
-    df_fato = con.execute("""
-        SELECT DISTINCT id, prod_name, price
-        FROM silver_produtos    
-    """).fetchdf()
-    
-    # Cria tabela fato no banco de dados
-    con.execute(f"DROP TABLE IF EXISTS {TABLE_NAME_FAT}")
-    
     con.execute(f"""
-        CREATE TABLE IF NOT EXISTS {TABLE_NAME_FAT} (
-            id bigint,           -- Chave primária
-            prod_name string,    -- Nome do produto  
-            price float          -- Preço do produto
-        )
+        CREATE OR REPLACE TABLE {TABLE_NAME_FAT} AS
+        SELECT id, prod_name, price
+        FROM {TABLE_NAME_SILVER}
     """)
-    
-    # Insere dados na tabela fato
-    con.execute(f"INSERT INTO {TABLE_NAME_FAT} SELECT * FROM df_fato")
-    logger.info(f"Tabela fato criada com {len(df_fato)} registros")
+
+    fact_count = silver_count
+    logger.info("Tabela fato criada com %d registros", fact_count)
 except Exception as e:
-    logger.error(f"Erro ao criar tabela fato: {e}")
+    logger.error("Erro ao criar tabela fato: %s", e)
+    con.execute("ROLLBACK")
     raise
 
 # Cria tabela dimensão com id, id_categoria e fornecedor
 try:
-    df_dim = con.execute("""
-        SELECT DISTINCT id, id_category, supplier
-        FROM silver_produtos    
-    """).fetchdf()
-    
-    # Cria tabela dimensão no banco de dados
-    con.execute(f"DROP TABLE IF EXISTS {TABLE_NAME_DIM}")
-    
     con.execute(f"""
-        CREATE TABLE IF NOT EXISTS {TABLE_NAME_DIM} (
-            id bigint,           -- Chave primária
-            id_category string,  -- Categoria do produto
-            supplier bigint      -- ID do fornecedor
-        )
+        CREATE OR REPLACE TABLE {TABLE_NAME_DIM} AS
+        SELECT id, id_category, supplier
+        FROM {TABLE_NAME_SILVER}
     """)
-    
-    # Insere dados na tabela dimensão
-    con.execute(f"INSERT INTO {TABLE_NAME_DIM} SELECT * FROM df_dim")
-    logger.info(f"Tabela dimensão criada com {len(df_dim)} registros")
+
+    dim_count = silver_count
+    logger.info("Tabela dimensão criada com %d registros", dim_count)
 except Exception as e:
-    logger.error(f"Erro ao criar tabela dimensão: {e}")
+    logger.error("Erro ao criar tabela dimensão: %s", e)
+    con.execute("ROLLBACK")
     raise
 
+con.execute("COMMIT")
+
 # Exibe estatísticas finais
 logger.info("Pipeline ETL concluído com sucesso")
 logger.info("Estatísticas finais:")
-bronze_count = con.execute(f"SELECT COUNT(*) FROM {TABLE_NAME_BRONZE}").fetchone()[0]
-silver_count = con.execute(f"SELECT COUNT(*) FROM {TABLE_NAME_SILVER}").fetchone()[0]
-fact_count = con.execute(f"SELECT COUNT(*) FROM {TABLE_NAME_FAT}").fetchone()[0]
-dim_count = con.execute(f"SELECT COUNT(*) FROM {TABLE_NAME_DIM}").fetchone()[0]
-
-logger.info(f"- Registros na camada Bronze: {bronze_count}")
-logger.info(f"- Registros na camada Silver: {silver_count}")
-logger.info(f"- Registros na tabela Fato: {fact_count}")
-logger.info(f"- Registros na tabela Dimensão: {dim_count}")
+# Reutiliza as contagens já obtidas ao final de cada camada
+logger.info("- Registros na camada Bronze: %d", bronze_count)
+logger.info("- Registros na camada Silver: %d", silver_count)
+logger.info("- Registros na tabela Fato: %d", fact_count)
+logger.info("- Registros na tabela Dimensão: %d", dim_count)
 
 # ------------------------------------------------------------
 # Exibição dos dados para validação
@@ -247,18 +316,18 @@ print("ESTRUTURA DO DATA LAKEHOUSE - LISTAGEM DE TABELAS")
 print("="*80)
 
 # Lista todas as tabelas no banco
-all_tables = con.execute("SHOW TABLES").fetchdf()
+all_tables = con.sql("SHOW TABLES")
 print("\nTabelas no banco de dados:")
 print(all_tables)
 
-# Função para exibir amostra de tabela
-def exibir_amostra(nome_tabela, descricao):
+# Função para exibir amostra de tabela (total de registros já calculado nas estatísticas)
+def exibir_amostra(nome_tabela, descricao, total_registros):
     print("\n" + "-"*80)
     print(f"{descricao} ({nome_tabela})")
     print("-"*80)
-    dados = con.execute(f"SELECT * FROM {nome_tabela} LIMIT 5").fetchdf()
+    dados = con.sql(f"SELECT * FROM {nome_tabela} LIMIT 5")
     print(dados)
-    print(f"Total de registros: {con.execute(f'SELECT COUNT(*) FROM {nome_tabela}').fetchone()[0]}")
+    print(f"Total de registros: {total_registros}")
 
 # Exibe amostras de cada camada
 print("\n\n" + "="*80)
@@ -266,16 +335,16 @@ print("AMOSTRAS DE DADOS DAS CAMADAS")
 print("="*80)
 
 # Camada Bronze
-exibir_amostra(TABLE_NAME_BRONZE, "CAMADA BRONZE - Dados brutos com metadados")
+exibir_amostra(TABLE_NAME_BRONZE, "CAMADA BRONZE - Dados brutos com metadados", bronze_count)
 
 # Camada Silver
-exibir_amostra(TABLE_NAME_SILVER, "CAMADA SILVER - Dados limpos e transformados")
+exibir_amostra(TABLE_NAME_SILVER, "CAMADA SILVER - Dados limpos e transformados", silver_count)
 
 # Camada Gold - Tabela Fato
-exibir_amostra(TABLE_NAME_FAT, "CAMADA GOLD - Tabela Fato (Produtos)")
+exibir_amostra(TABLE_NAME_FAT, "CAMADA GOLD - Tabela Fato (Produtos)", fact_count)
 
 # Camada Gold - Tabela Dimensão
-exibir_amostra(TABLE_NAME_DIM, "CAMADA GOLD - Tabela Dimensão (Categorias e Fornecedores)")
+exibir_amostra(TABLE_NAME_DIM, "CAMADA GOLD - Tabela Dimensão (Categorias e Fornecedores)", dim_count)
 
 # Fecha a conexão com o banco de dados
 con.close()
@@ -285,4 +354,4 @@ logger.info("Conexão com o banco encerrada")
 end_time = time.time()
 execution_time = end_time - start_time
 
-logger.info(f"Tempo total de execução do pipeline: {execution_time:.2f} segundos")
\ No newline at end of file
+logger.info("Tempo total de execução do pipeline: %.2f segundos", execution_time)
\ No newline at end of file